@@ -13,7 +13,7 @@ setup(
         "Programming Language :: Python :: 3",
         "Operating System :: OS Independent",
     ],
-    python_requires='>=3.5',
+    python_requires='>=3.8',
 
     version="0.5",
     packages=['spectre', 'spectre.data', 'spectre.factors', 'spectre.parallel', 'spectre.trading',
@@ -117,15 +117,11 @@ class ElementWiseMax(CustomFactor):
 
     @classmethod
     def binary_fill_na(cls, a, b, value):
-        a = a.clone()
-        b = b.clone()
         if a.dtype != b.dtype or a.dtype not in (torch.float32, torch.float64, torch.float16):
             a = a.type(torch.float32)
             b = b.type(torch.float32)
 
-        a.masked_fill_(torch.isnan(a), value)
-        b.masked_fill_(torch.isnan(b), value)
-        return a, b
+        return torch.where(torch.isnan(a), value, a), torch.where(torch.isnan(b), value, b)
 
     def compute(self, a, b):
         ret = torch.max(*ElementWiseMax.binary_fill_na(a, b, -np.inf))
@@ -627,8 +627,7 @@ class RankFactor(CrossSectionFactor):
 
     def compute(self, data: torch.Tensor) -> torch.Tensor:
         if not self.ascending:
-            filled = data.clone()
-            filled.masked_fill_(torch.isnan(data), -np.inf)
+            filled = torch.where(torch.isnan(data), -np.inf, data)
         else:
             filled = data
         _, indices = torch.sort(filled, dim=1, descending=not self.ascending)
@@ -5,52 +5,85 @@
 @email: heeroz@gmail.com
 """
 from typing import Callable, Tuple
+from functools import lru_cache
+import os
+import warnings
 import torch
 import numpy as np
 
+# Rolling allocates big blocks of varying size, expandable segments avoids the fragmentation
+# OOM in long runs. Only takes effect if CUDA not initialized yet, and user settings first.
+# torch 2.0 rejects this unknown option on the first CUDA allocation, so 2.1+ only.
+if tuple(map(int, torch.__version__.split('.')[:2])) >= (2, 1):
+    os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True')
+
+
+@lru_cache(maxsize=None)
+def _int32_index_supported(device: torch.device) -> bool:
+    """int32 index of gather/scatter_ only supported by newer version of torch"""
+    try:
+        index = torch.zeros(1, dtype=torch.int32, device=device)
+        src = torch.zeros(1, device=device)
+        src.scatter_(0, index, torch.gather(src, 0, index))
+        return True
+    except RuntimeError:
+        return False
+
+
+def _take(data: torch.Tensor, indices: torch.Tensor) -> torch.Tensor:
+    if indices.dtype == torch.int64:
+        return torch.take(data, indices)
+    # torch.take only accepts int64 index, gather on the flattened data instead
+    return torch.gather(data.reshape(-1), 0, indices.view(-1)).view(indices.shape)
+
 
 class ParallelGroupBy:
     """Fast parallel group by"""
 
     def __init__(self, keys: torch.Tensor):
         n = keys.shape[0]
-        # sort by key (keep key in GPU device)
-        relative_key = keys + torch.linspace(0, 0.9, n, dtype=torch.double, device=keys.device)
-        sorted_keys, sorted_indices = torch.sort(relative_key)
-        sorted_keys, sorted_indices = sorted_keys.int(), sorted_indices.cpu()
-        # get group boundary
-        diff = sorted_keys[1:] - sorted_keys[:-1]
-        boundary = (diff.nonzero(as_tuple=True)[0] + 1).tolist()
-        boundary = np.array([0] + boundary + [n])
-        # get inverse indices
-        width = np.diff(boundary).max()
-        groups = len(boundary) - 1
-        inverse_indices = sorted_indices.new_full((groups, width), n + 1)
-        for start, end, i in zip(boundary[:-1], boundary[1:], range(groups)):
-            inverse_indices[i, 0:(end - start)] = sorted_indices[start:end]
-        # keep inverse_indices in GPU for sort
-        inverse_indices = inverse_indices.flatten().to(keys.device, non_blocking=True)
-        inverse_indices = torch.sort(inverse_indices)[1][:n]
-        # for fast split
-        take_indices = sorted_indices.new_full((groups, width), -1)
-        for start, end, i in zip(boundary[:-1], boundary[1:], range(groups)):
-            take_indices[i, 0:(end - start)] = sorted_indices[start:end]
-        take_indices = take_indices.to(keys.device, non_blocking=True)
+        # sort by key (keep key in GPU device), stable sort keeps original order in group
+        sorted_keys, sorted_indices = torch.sort(keys, stable=True)
+        counts = torch.unique_consecutive(sorted_keys, return_counts=True)[1]
+        width = counts.max().item()
+        groups = counts.shape[0]
+        # int32 indices halve the gather bandwidth of split/revert on GPU, but slower on CPU
+        index_type = torch.int64
+        if keys.is_cuda and groups * width < 2 ** 31 and _int32_index_supported(keys.device):
+            index_type = torch.int32
+        sorted_indices = sorted_indices.to(index_type)
+        # get group boundary, keep it in device, only the width needs to be known by host
+        starts = (counts.cumsum(0) - counts).to(index_type)
+        # position of each sorted element in the (groups, width) padded layout
+        row = torch.repeat_interleave(
+            torch.arange(groups, device=keys.device, dtype=index_type), counts, output_size=n)
+        col = torch.arange(n, device=keys.device, dtype=index_type) - starts[row]
+        flat_pos = row * width + col
+        # for fast split, padding slots point to element 0, so split can gather without fix up
+        take_indices = sorted_indices.new_zeros((groups * width,))
+        take_indices.scatter_(0, flat_pos, sorted_indices)
+        take_indices = take_indices.view(groups, width)
+        # get inverse indices, invert the sort permutation by scatter instead of sorting again
+        inverse_indices = torch.empty_like(sorted_indices).scatter_(0, sorted_indices, flat_pos)
         # class members
-        self._boundary = boundary
         self._sorted_indices = take_indices
-        self._padding_mask = take_indices == -1
         self._inverse_indices = inverse_indices
+        self._counts = counts.to(index_type)
+        self._columns = torch.arange(width, device=keys.device, dtype=index_type)
         self._width = width
         self._groups = groups
         self._data_shape = (groups, width)
 
+    @property
+    def padding_mask(self) -> torch.Tensor:
+        """(groups, width) mask of the padding slots, computed from group sizes on demand"""
+        return self._columns >= self._counts.unsqueeze(-1)
+
     def split(self, data: torch.Tensor) -> torch.Tensor:
-        ret = torch.take(data, self._sorted_indices)
-        assert ret.dtype not in {torch.int8, torch.int16, torch.int32, torch.int64}, \
+        assert data.dtype not in {torch.int8, torch.int16, torch.int32, torch.int64}, \
             'tensor cannot be any type of int, recommended to use float32'
-        ret.masked_fill_(self._padding_mask, np.nan)
-        return ret
+        return torch.where(self.padding_mask, data.new_full((), np.nan),
+                           _take(data, self._sorted_indices))
 
     def revert(self, split_data: torch.Tensor, dbg_str='None') -> torch.Tensor:
         if tuple(split_data.shape) != self._data_shape:
@@ -63,23 +96,21 @@ class ParallelGroupBy:
             else:
                 raise ValueError('The return data shape{} of Factor `{}` must same as input{}.'
                                  .format(tuple(split_data.shape), dbg_str, self._data_shape))
-        return torch.take(split_data, self._inverse_indices)
+        return _take(split_data, self._inverse_indices)
 
     def create(self, dtype, values, nan_fill=np.nan):
         ret = self._sorted_indices.new_full(self._sorted_indices.shape, values, dtype=dtype)
-        ret.masked_fill_(self._padding_mask, nan_fill)
+        ret.masked_fill_(self.padding_mask, nan_fill)
         return ret
 
 
 def masked_sum(data: torch.Tensor, mask: torch.Tensor, dim=1) -> torch.Tensor:
-    data = data.clone()
-    data.masked_fill_(mask, 0)  # much faster than data[isnan] = 0
-    return data.sum(dim=dim)
+    # no clone, torch.where selects the fill value in one pass
+    return torch.where(mask, 0, data).sum(dim=dim)
 
 
 def nansum(data: torch.Tensor, dim=1) -> torch.Tensor:
-    mask = torch.isnan(data)
-    return masked_sum(data, mask, dim)
+    return torch.nansum(data, dim=dim)
 
 
 def masked_mean(data, mask, dim=1):
@@ -88,50 +119,86 @@ def masked_mean(data, mask, dim=1):
 
 
 def nanmean(data: torch.Tensor, dim=1) -> torch.Tensor:
-    mask = torch.isnan(data)
-    return masked_mean(data, mask, dim)
+    if not data.is_floating_point():
+        # torch.nanmean only accepts float, bool/int mean is a ratio anyway
+        data = data.to(torch.get_default_dtype())
+    return torch.nanmean(data, dim=dim)
 
 
-def nanvar(data: torch.Tensor, dim=1, ddof=0) -> torch.Tensor:
+def _nanvar(data: torch.Tensor, dim: int, ddof: int) -> torch.Tensor:
     mask = torch.isnan(data)
-    total = masked_sum(data, mask, dim)
     n = (~mask).sum(dim=dim)
-    mean = total / n
-    mean.unsqueeze_(-1)
-    var = (data - mean) ** 2 / (n.unsqueeze(-1) - ddof)
-    var.masked_fill_(mask, 0)
-    return var.sum(dim=dim)
+    mean = torch.nansum(data, dim=dim) / n
+    diff = torch.where(mask, 0, data - mean.unsqueeze(dim))
+    # divide after reduction, only one division per row
+    sse = (diff * diff).sum(dim=dim)
+    return torch.where(n > ddof, sse / (n - ddof), np.nan)
+
+
+_nanvar_fused = None
+_nanvar_fused_verified = False
+
+
+def nanvar(data: torch.Tensor, dim=1, ddof=0) -> torch.Tensor:
+    global _nanvar_fused, _nanvar_fused_verified
+    if not data.is_cuda:
+        return _nanvar(data, dim, ddof)
+    if _nanvar_fused is None:
+        # let inductor fuse the whole map-reduce into one kernel, needs triton on GPU
+        try:
+            from torch.utils._triton import has_triton
+            use_triton = has_triton()
+        except ImportError:
+            use_triton = False
+        if use_triton:
+            _nanvar_fused = torch.compile(_nanvar, fullgraph=True, dynamic=True)
+        else:
+            _nanvar_fused = _nanvar
+            _nanvar_fused_verified = True
+    if not _nanvar_fused_verified:
+        # compile errors raise on the first call, if so, fall back to eager permanently.
+        # TorchRuntimeError is a real error of the input (bad dim etc.), don't swallow it.
+        from torch._dynamo.exc import TorchDynamoException, TorchRuntimeError
+        try:
+            ret = _nanvar_fused(data, dim, ddof)
+            _nanvar_fused_verified = True
+            return ret
+        except TorchRuntimeError:
+            raise
+        except TorchDynamoException as e:
+            warnings.warn("torch.compile of nanvar failed, fall back to eager mode: "
+                          "{}".format(e), RuntimeWarning)
+            _nanvar_fused = _nanvar
+            _nanvar_fused_verified = True
+    return _nanvar_fused(data, dim, ddof)
 
 
 def nanstd(data: torch.Tensor, dim=1, ddof=0) -> torch.Tensor:
-    return nanvar(data, dim, ddof).sqrt()
+    return nanvar(data, dim, ddof).sqrt_()
 
 
 def nanmax(data: torch.Tensor, dim=1) -> torch.Tensor:
-    data = data.clone()
-    isnan = torch.isnan(data)
-    data.masked_fill_(isnan, -np.inf)
-    return data.max(dim=dim)[0]
+    if not data.is_floating_point():
+        return data.amax(dim=dim)
+    return torch.where(torch.isnan(data), -np.inf, data).amax(dim=dim)
 
 
 def nanmin(data: torch.Tensor, dim=1) -> torch.Tensor:
-    data = data.clone()
-    isnan = torch.isnan(data)
-    data.masked_fill_(isnan, np.inf)
-    return data.min(dim=dim)[0]
+    if not data.is_floating_point():
+        return data.amin(dim=dim)
+    return torch.where(torch.isnan(data), np.inf, data).amin(dim=dim)
 
 
 def masked_last(data: torch.Tensor, mask: torch.Tensor, dim=1, reverse=False) -> torch.Tensor:
+    # 1-based position of each True element, the max one is the last, 0 means all False
+    shape = [1] * mask.dim()
+    shape[dim] = mask.shape[dim]
+    pos = torch.arange(1, mask.shape[dim] + 1, device=mask.device, dtype=torch.int32)
     if reverse:
-        w = torch.linspace(0.1, 0.0, mask.shape[-1], dtype=torch.float, device=mask.device)
-    else:
-        w = torch.linspace(0.0, 0.1, mask.shape[-1], dtype=torch.float, device=mask.device)
-    w = mask.float() + w
-    last = w.argmax(dim=dim)
-    ret = data.gather(dim, last.unsqueeze(-1)).squeeze(-1)
-    ret_mask = mask.gather(dim, last.unsqueeze(-1)).squeeze(-1)
-    ret = torch.masked_fill(ret, ~ret_mask, np.nan)
-    return ret
+        pos = pos.flip(0)
+    pos, last = (mask * pos.view(shape)).max(dim=dim, keepdim=True)
+    ret = data.gather(dim, last).squeeze(dim)
+    return ret.masked_fill(pos.squeeze(dim) == 0, np.nan)
 
 
 def masked_first(data: torch.Tensor, mask: torch.Tensor, dim=1) -> torch.Tensor:
@@ -152,32 +219,45 @@ def pad_2d(data: torch.Tensor) -> torch.Tensor:
     return torch.gather(data, 1, idx)
 
 
+def _pairwise_demean(x, y, dim):
+    """demean x and y on the pairwise complete (both non-nan) elements, nan filled by 0"""
+    mask = torch.isnan(x) | torch.isnan(y)
+    n = (~mask).sum(dim=dim)
+    x = torch.where(mask, 0, x)
+    y = torch.where(mask, 0, y)
+    x_bar = x.sum(dim=dim) / n
+    y_bar = y.sum(dim=dim) / n
+    demean_x = torch.where(mask, 0, x - x_bar.unsqueeze(dim))
+    demean_y = torch.where(mask, 0, y - y_bar.unsqueeze(dim))
+    return demean_x, demean_y, x_bar, y_bar, n
+
+
+def _batched_dot(x, y, dim):
+    """row-wise dot product along `dim`, as one batched GEMV: (..., 1, W) @ (..., W, 1)"""
+    x = x.movedim(dim, -1).unsqueeze(-2)
+    y = y.movedim(dim, -1).unsqueeze(-1)
+    return torch.matmul(x, y)[..., 0, 0]
+
+
 def covariance(x, y, dim=1, ddof=0):
-    x_bar = nanmean(x, dim=dim).unsqueeze(-1)
-    y_bar = nanmean(y, dim=dim).unsqueeze(-1)
-    demean_x = x - x_bar
-    demean_y = y - y_bar
-    xy = demean_x * demean_y
-    mask = torch.isnan(xy)
-    e = masked_sum(xy, mask, dim=dim)
-    return e / ((~mask).sum(dim=dim) - ddof)
+    demean_x, demean_y, _, _, n = _pairwise_demean(x, y, dim)
+    return _batched_dot(demean_x, demean_y, dim) / (n - ddof)
 
 
 def pearsonr(x, y, dim=1, ddof=0):
-    cov = covariance(x, y, dim, ddof)
-    return cov / (nanstd(x, dim, ddof) * nanstd(y, dim, ddof))
+    # ddof cancels out in correlation
+    demean_x, demean_y, _, _, _ = _pairwise_demean(x, y, dim)
+    cov = _batched_dot(demean_x, demean_y, dim)
+    return cov / (torch.linalg.vector_norm(demean_x, dim=dim) *
+                  torch.linalg.vector_norm(demean_y, dim=dim))
 
 
 def linear_regression_1d(x, y, dim=1):
-    x_bar = nanmean(x, dim=dim).unsqueeze(-1)
-    y_bar = nanmean(y, dim=dim).unsqueeze(-1)
-    demean_x = x - x_bar
-    demean_y = y - y_bar
-    cov = nanmean(demean_x * demean_y, dim=dim)
-    x_var = nanvar(x, dim=dim, ddof=0)
-    slope = cov / x_var
-    slope[x_var == 0] = 0
-    intcp = y_bar.squeeze() - slope * x_bar.squeeze()
+    demean_x, demean_y, x_bar, y_bar, _ = _pairwise_demean(x, y, dim)
+    sxy = _batched_dot(demean_x, demean_y, dim)
+    sxx = _batched_dot(demean_x, demean_x, dim)
+    slope = torch.where(sxx == 0, 0, sxy / sxx)
+    intcp = y_bar - slope * x_bar
     return slope, intcp
 
 
@@ -224,9 +304,11 @@ class Rolling:
 
     @classmethod
     def unfold(cls, x, win, fill=np.nan):
-        nan_stack = x.new_full((x.shape[0], win - 1), fill)
-        new_x = torch.cat((nan_stack, x), dim=1)
-        return new_x.unfold(1, win, 1)
+        # write the padded copy once, then expose it as a strided (N, T, win) view
+        base = x.new_empty((x.shape[0], x.shape[1] + win - 1))
+        base[:, :win - 1] = fill
+        base[:, win - 1:] = x
+        return base.as_strided((x.shape[0], x.shape[1], win), (base.stride(0), 1, 1))
 
     def __init__(self, x: torch.Tensor, win: int, _adjustment: torch.Tensor = None):
         self.values = self.unfold(x, win)
@@ -246,6 +328,7 @@ class Rolling:
         else:
             self.adjustments = None
             self.adjustment_last = None
+        self._scratch = None
 
     def adjust(self, s=None, e=None) -> torch.Tensor:
         """this will contiguous tensor consume lot of memory, limit e-s size"""
@@ -254,6 +337,23 @@ class Rolling:
         else:
             return self.values[:, s:e]
 
+    def _adjust_scratch(self, s, e) -> torch.Tensor:
+        """
+        Same as `adjust`, but write into a buffer reused by all splits of this object, the
+        returned tensor is only valid until next call.
+        """
+        if self.adjustments is None:
+            return self.values[:, s:e]
+        shape = (self.values.shape[0], e - s, self.win)
+        size = shape[0] * shape[1] * shape[2]
+        if self._scratch is None or self._scratch.nelement() < size:
+            dtype = torch.promote_types(self.values.dtype, self.adjustments.dtype)
+            dtype = torch.promote_types(dtype, self.adjustment_last.dtype)
+            self._scratch = self.values.new_empty(size, dtype=dtype)
+        out = self._scratch[:size].view(shape)
+        torch.mul(self.values[:, s:e], self.adjustments[:, s:e], out=out)
+        return out.div_(self.adjustment_last[:, s:e])
+
     def __repr__(self):
         return 'spectre.parallel.Rolling object contains:\n' + self.values.__repr__()
 
@@ -263,13 +363,31 @@ class Rolling:
         and finally aggregate them into a whole.
         """
         assert all(r.win == self.win for r in others), '`others` must have same `win` with `self`'
-        seq = [op(self.adjust(s, e), *[r.adjust(s, e) for r in others]).contiguous()
-               for s, e in self.split]
-        return torch.cat(seq, dim=1)
+        if len(self.split) == 1:
+            return op(self.adjust(), *[r.adjust() for r in others]).contiguous()
+        # write each split result into one preallocated output, avoid the torch.cat copy
+        ret = None
+        for s, e in self.split:
+            # each result is copied into `ret` before next split, so adjusted data can reuse
+            # the scratch buffer instead of allocating a new block per split.
+            seq = op(self._adjust_scratch(s, e), *[r._adjust_scratch(s, e) for r in others])
+            if ret is None:
+                ret = seq.new_empty((seq.shape[0], self.values.shape[1], *seq.shape[2:]))
+            ret[:, s:e] = seq
+        return ret
+
+    def _reduce(self, op: Callable):
+        """
+        Like `agg`, but `op` must be a plain reduction which reads the strided values directly
+        without any temporary, so if there is no adjustment, the split is unnecessary.
+        """
+        if self.adjustments is None:
+            return op(self.values)
+        return self.agg(op)
 
     def loc(self, i):
-        if i == -1:
-            # last doesn't need to adjust, just return directly
+        if i == -1 or self.adjustments is None:
+            # last doesn't need to adjust, just return the strided view directly
             return self.values[:, :, i]
 
         def _loc(x):
@@ -287,13 +405,13 @@ class Rolling:
         return self.loc(0)
 
     def sum(self, axis=2):
-        return self.agg(lambda x: x.sum(dim=axis))
+        return self._reduce(lambda x: x.sum(dim=axis))
 
     def nansum(self, axis=2):
         return self.agg(lambda x: nansum(x, dim=axis))
 
     def mean(self, axis=2):
-        return self.agg(lambda x: x.sum(dim=axis) / self.win)
+        return self._reduce(lambda x: x.sum(dim=axis) / self.win)
 
     def nanmean(self, axis=2):
         return self.agg(lambda x: nanmean(x, dim=axis))
@@ -312,10 +430,10 @@ class Rolling:
         return self.agg(lambda x: nanvar(x, dim=axis, ddof=0))
 
     def max(self):
-        return self.agg(lambda x: x.max(dim=2)[0])
+        return self._reduce(lambda x: x.amax(dim=2))
 
     def min(self):
-        return self.agg(lambda x: x.min(dim=2)[0])
+        return self._reduce(lambda x: x.amin(dim=2))
 
     def nanmax(self):
         return self.agg(lambda x: nanmax(x, dim=2))
@@ -53,6 +53,34 @@ class TestParallelAlgorithm(unittest.TestCase):
         x = torch.zeros([1024, 102400], dtype=torch.float64)
         spectre.parallel.Rolling(x, 252).sum()
 
+        # test multiple splits with adjustment, should same as single split
+        rng = np.random.default_rng(0)
+        x = torch.tensor(rng.random((30, 50)))
+        x[x < 0.2] = np.nan
+        y = torch.tensor(rng.random((30, 50)))
+        x_adj = torch.tensor(rng.random((30, 50))) + 0.5
+        y_adj = torch.tensor(rng.random((30, 50))) + 0.5
+
+        def _cov(_x, _y):
+            return spectre.parallel.covariance(_x, _y, dim=2, ddof=1)
+
+        def calc():
+            rx = spectre.parallel.Rolling(x, 7, x_adj)
+            ry = spectre.parallel.Rolling(y, 7, y_adj)
+            return rx.split, rx.agg(_cov, ry), rx.agg(_cov, rx), rx.nanstd()
+
+        single_split, *expected = calc()
+        self.assertEqual(1, len(single_split))
+        old_multi = spectre.parallel.Rolling._split_multi
+        spectre.parallel.Rolling._split_multi = 2e5
+        try:
+            multi_split, *result = calc()
+        finally:
+            spectre.parallel.Rolling._split_multi = old_multi
+        self.assertGreater(len(multi_split), 2)
+        for e, r in zip(expected, result):
+            assert_almost_equal(e.numpy(), r.numpy())
+
     def test_nan(self):
         # dim=1
         data = [[1, 2, 1], [4, np.nan, 2], [7, 8, 1]]
@@ -118,6 +146,28 @@ class TestParallelAlgorithm(unittest.TestCase):
         expected = np.nanmin(data, axis=1)
         assert_almost_equal(expected, result, decimal=6)
 
+        # bool/int input
+        data = [[True, False, True], [False, False, True]]
+        result = spectre.parallel.nanmean(torch.tensor(data))
+        assert_almost_equal([2 / 3, 1 / 3], result, decimal=6)
+        result = spectre.parallel.nanmax(torch.tensor(data))
+        assert_array_equal([True, True], result)
+        data = [[1, 2, 4], [3, 3, 6]]
+        result = spectre.parallel.nanmean(torch.tensor(data))
+        assert_almost_equal([7 / 3, 4], result, decimal=6)
+        result = spectre.parallel.nanmin(torch.tensor(data))
+        assert_array_equal([1, 3], result)
+
+        # all nan row
+        data = [[1, 2, 4], [np.nan, np.nan, np.nan], [np.nan, 3, np.nan]]
+        for ddof in (0, 1):
+            result = spectre.parallel.nanvar(torch.tensor(data), ddof=ddof)
+            expected = [np.nanvar(row, ddof=ddof) if ddof < np.count_nonzero(~np.isnan(row))
+                        else np.nan for row in data]
+            assert_almost_equal(expected, result, decimal=6)
+            result = spectre.parallel.nanstd(torch.tensor(data), ddof=ddof)
+            assert_almost_equal(np.sqrt(expected), result, decimal=6)
+
     def test_stat(self):
         x = torch.tensor([[1., 2, 3, 4, 5], [10, 12, 13, 14, 16], [2, 2, 2, 2, 2, ]])
         y = torch.tensor([[-1., 2, 3, 4, -5], [11, 12, -13, 14, 15], [2, 2, 2, 2, 2, ]])
@@ -132,6 +182,15 @@ class TestParallelAlgorithm(unittest.TestCase):
             reg = LinearRegression().fit(x[i, :, None], y[i, :, None])
             assert_almost_equal(reg.coef_, coef[i], decimal=6)
 
+        # test linear regression with nan
+        nan_y = y.clone()
+        nan_y[0, 1] = np.nan
+        coef, intcp = spectre.parallel.linear_regression_1d(x, nan_y)
+        mask = ~torch.isnan(nan_y[0])
+        reg = LinearRegression().fit(x[0, mask, None], nan_y[0, mask, None])
+        assert_almost_equal(reg.coef_, coef[0], decimal=6)
+        assert_almost_equal(reg.intercept_, intcp[0], decimal=5)
+
         # test pearsonr
         result = spectre.parallel.pearsonr(x, y)
         from scipy import stats
@@ -139,6 +198,15 @@ class TestParallelAlgorithm(unittest.TestCase):
             expected, _ = stats.pearsonr(x[i], y[i])
             assert_almost_equal(expected, result[i], decimal=6)
 
+        # test pearsonr with nan, only pairwise complete data is used
+        x[0, 1] = np.nan
+        y[1, 3] = np.nan
+        result = spectre.parallel.pearsonr(x, y)
+        for i in range(2):
+            mask = ~(torch.isnan(x[i]) | torch.isnan(y[i]))
+            expected, _ = stats.pearsonr(x[i][mask], y[i][mask])
+            assert_almost_equal(expected, result[i], decimal=6)
+
         # test quantile
         x = torch.tensor([[1, 2, np.nan, 3, 4, 5, 6], [3, 4, 5, 1.01, np.nan, 1.02, 1.03]])
         result = spectre.parallel.quantile(x, 5, dim=1)